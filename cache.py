@@ -0,0 +1,39 @@
+'''This module contains the in-process response cache
+for the `Treasures` FastAPI app.'''
+from collections import OrderedDict
+from threading import Lock
+
+
+class ResponseCache:
+    '''An LRU cache of read responses that writes invalidate as a whole.
+
+    Readers take `version` before querying and pass it back to `set`, so a
+    response built from rows that a concurrent write has since changed is
+    never stored.'''
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.version = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def set(self, key, value, version):
+        with self._lock:
+            if version != self.version:
+                return
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self):
+        with self._lock:
+            self.version += 1
+            self._entries.clear()
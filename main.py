@@ -1,15 +1,73 @@
 '''This module is the entrypoint for the 'Treasures' FastAPI app.'''
-from fastapi import FastAPI, HTTPException, Query
-from db.connection import connect_to_db
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Query, Depends, Request, Body
+from fastapi.responses import ORJSONResponse, Response
+from db.connection import create_pool
+from cache import ResponseCache
+from pydantic import BaseModel, Field
 from typing import Annotated
-from pg8000.exceptions import DatabaseError
+from enum import Enum
+from itertools import product
+from contextlib import asynccontextmanager
+from psycopg import Connection
+from psycopg.errors import ForeignKeyViolation, DataError
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+import logging
+import orjson
 
-app = FastAPI()
+logger = logging.getLogger(__name__)
+
+
+class DeferredQueueHandler(QueueHandler):
+    '''Queues records unformatted, leaving formatting to the listener thread.
+
+    QueueHandler.prepare() would format the message on the logging thread.'''
+
+    def prepare(self, record):
+        return record
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Request threads only put records on a queue; a listener thread formats
+    # and writes them, so logging never blocks a request on stderr. The
+    # logger doesn't propagate, so root handlers can't write on the request
+    # thread either.
+    log_queue = SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    log_listener = QueueListener(log_queue, stream_handler)
+    logger.addHandler(queue_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    log_listener.start()
+
+    try:
+        app.state.pool = create_pool(min_size=5, max_size=20)
+        try:
+            yield
+        finally:
+            app.state.pool.close()
+    finally:
+        log_listener.stop()
+        logger.removeHandler(queue_handler)
+        logger.propagate = True
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
+# Reads are served from here until the next write to either table.
+response_cache = ResponseCache(maxsize=256)
+
+def get_conn(request: Request):
+    # Sync generator on purpose: FastAPI runs it in the threadpool too.
+    with request.app.state.pool.connection() as conn:
+        yield conn
 
 class NewTreasure(BaseModel):
-    treasure_name : str
-    colour : str
+    # Lengths match the VARCHAR columns in db/seed.py.
+    treasure_name : str = Field(max_length=256)
+    colour : str = Field(max_length=42)
     age : int
     cost_at_auction : float
     shop_id : int
@@ -17,133 +75,189 @@ class NewTreasure(BaseModel):
 class NewPrice(BaseModel):
     cost_at_auction : float
 
-treasures_columns = ["treasure_id", "treasure_name", "colour",
-                     "age", "cost_at_auction", "shop_name"]
-order_options = ['asc', 'desc']
+class SortBy(str, Enum):
+    treasure_id = "treasure_id"
+    treasure_name = "treasure_name"
+    colour = "colour"
+    age = "age"
+    cost_at_auction = "cost_at_auction"
+    shop_name = "shop_name"
+
+class Order(str, Enum):
+    asc = "asc"
+    desc = "desc"
+
+def build_treasures_query(sort_by, order, by_colour, by_min_age, by_max_age):
+    filters = []
+    if by_colour:
+        filters.append("treasures.colour = %(colour)s")
+    if by_min_age:
+        filters.append("treasures.age >= %(min_age)s")
+    if by_max_age:
+        filters.append("treasures.age <= %(max_age)s")
+    where = f"WHERE {' AND '.join(filters)}" if filters else ""
+    return f"""SELECT
+              treasures.treasure_id,
+              treasures.treasure_name,
+              treasures.colour,
+              treasures.age,
+              treasures.cost_at_auction,
+              shops.shop_name
+              FROM treasures
+              JOIN shops ON treasures.shop_id = shops.shop_id
+              {where}
+              ORDER BY {sort_by.value} {order.value}, treasures.treasure_id
+              LIMIT %(limit)s OFFSET %(offset)s"""
+
+# Every listing query, built once at import and keyed by sort, order and
+# which of the colour/min_age/max_age filters are set.
+treasure_queries = {(sort_by, order, *active): build_treasures_query(sort_by, order, *active)
+                    for sort_by in SortBy
+                    for order in Order
+                    for active in product((False, True), repeat=3)}
 
+# psycopg's Connection is blocking, so the path operations are plain `def`:
+# FastAPI runs them in its threadpool and concurrent requests wait on the
+# database in parallel. Declaring them `async def` would run the blocking
+# calls on the event loop and serialise every request behind them.
 @app.get("/api/treasures")
-def get_treasures(sort_by: Annotated[str, Query()] = "age",
-                  order: Annotated[str, Query()] = 'asc',
+def get_treasures(sort_by: Annotated[SortBy, Query()] = SortBy.age,
+                  order: Annotated[Order, Query()] = Order.asc,
                   colour: Annotated[str, Query()] = None,
                   max_age: Annotated[int, Query()] = None,
-                  min_age: Annotated[int, Query()] = None):
-
-    if sort_by not in treasures_columns:
-        raise HTTPException(status_code=422, detail=f"Invalid sort field: {sort_by}")
-    if order not in order_options:
-        raise HTTPException(status_code=422, detail=f"Invalid order field: {order}")
-
-    conn = connect_to_db()
-
-    treasures = conn.run(f"""SELECT
-                         treasures.treasure_id,
-                         treasures.treasure_name,
-                         treasures.colour,
-                         treasures.age,
-                         treasures.cost_at_auction,
-                         shops.shop_name
-                         FROM treasures
-                         JOIN shops ON treasures.shop_id = shops.shop_id
-                         ORDER BY {sort_by} {order} """)
-
-    data = [{"treasure_id" : treasure[0],
-             "treasure_name" : treasure[1],
-             "colour" :  treasure[2],
-             "age" :  treasure[3],
-             "cost_at_auction" :  treasure[4],
-             "shop_name" : treasure[5]} for treasure in treasures]
-
-    if min_age:
-        data[:] = [treasure for treasure in data if treasure['age'] >= min_age]
-    if max_age:
-        data[:] = [treasure for treasure in data if treasure['age'] <= max_age]
-    if colour:
-        data[:] = [treasure for treasure in data if treasure['colour'] == colour]
-
-    response = {"treasures" : data}
-
-    conn.close()
-    return response
+                  min_age: Annotated[int, Query()] = None,
+                  limit: Annotated[int, Query(ge=1, le=1000)] = 100,
+                  offset: Annotated[int, Query(ge=0)] = 0,
+                  conn: Connection = Depends(get_conn)):
+
+    # As before filtering moved into SQL, `?colour=` means no colour filter.
+    colour = colour or None
+    cache_key = ("treasures", sort_by, order, colour, min_age, max_age,
+                 limit, offset)
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        return Response(cached, media_type="application/json")
+    cache_version = response_cache.version
+
+    params = {"limit" : limit, "offset" : offset}
+    if colour is not None:
+        params["colour"] = colour
+    if min_age is not None:
+        params["min_age"] = min_age
+    if max_age is not None:
+        params["max_age"] = max_age
+    sql = treasure_queries[(sort_by, order, colour is not None,
+                            min_age is not None, max_age is not None)]
+
+    treasures = conn.execute(sql, params).fetchall()
+
+    body = orjson.dumps({"treasures" : treasures})
+    response_cache.set(cache_key, body, cache_version)
+    return Response(body, media_type="application/json")
 
 @app.post("/api/treasures", status_code=201)
-def post_treasure(new_treasure: NewTreasure):
+def post_treasure(new_treasure: NewTreasure,
+                  conn: Connection = Depends(get_conn)):
 
     try:
-        conn = connect_to_db()
-        new_query = conn.run("""
+        new_query = conn.execute("""
             INSERT INTO treasures (treasure_name, colour, age, cost_at_auction, shop_id)
-            VALUES (:treasure_name, :colour, :age, :cost_at_auction, :shop_id) 
-            RETURNING *""",
-            treasure_name = new_treasure.treasure_name,
-            colour = new_treasure.colour,
-            age = new_treasure.age,
-            cost_at_auction = new_treasure.cost_at_auction,
-            shop_id = new_treasure.shop_id)
-        response = {"treasure" : {"treasure_id" : new_query[0][0],
-                                  "treasure_name" : new_query[0][1],
-                                  "colour" : new_query[0][2],
-                                  "age" : new_query[0][3],
-                                  "cost_at_auction" : new_query[0][4],
-                                  "shop_id" : new_query[0][5]}}
+            VALUES (%(treasure_name)s, %(colour)s, %(age)s, %(cost_at_auction)s, %(shop_id)s) 
+            RETURNING *""", new_treasure.model_dump()).fetchone()
+        response = {"treasure" : new_query}
+        response_cache.invalidate()
         return response
-    except DatabaseError as dberror:
+    except ForeignKeyViolation as dberror:
         raise HTTPException(status_code=422, detail=f"shop id {new_treasure.shop_id} is out of range")
-    finally:
-        conn.close()
+    except DataError as dberror:
+        raise HTTPException(status_code=422, detail=f"invalid treasure: {dberror.diag.message_primary}")
+
+@app.post("/api/treasures/bulk", status_code=201)
+def post_treasures(new_treasures: Annotated[list[NewTreasure], Body(max_length=1000)],
+                   conn: Connection = Depends(get_conn)):
+    # One column array per field, unnested server-side: a single statement
+    # inserts the whole batch in one round trip and one transaction.
+    try:
+        created = conn.execute("""
+            INSERT INTO treasures (treasure_name, colour, age, cost_at_auction, shop_id)
+            SELECT * FROM unnest(CAST(%(treasure_names)s AS VARCHAR[]),
+                                 CAST(%(colours)s AS VARCHAR[]),
+                                 CAST(%(ages)s AS INT[]),
+                                 CAST(%(costs)s AS FLOAT8[]),
+                                 CAST(%(shop_ids)s AS INT[]))
+            RETURNING *""", {
+            "treasure_names" : [treasure.treasure_name for treasure in new_treasures],
+            "colours" : [treasure.colour for treasure in new_treasures],
+            "ages" : [treasure.age for treasure in new_treasures],
+            "costs" : [treasure.cost_at_auction for treasure in new_treasures],
+            "shop_ids" : [treasure.shop_id for treasure in new_treasures]}).fetchall()
+    except ForeignKeyViolation as dberror:
+        raise HTTPException(status_code=422, detail="one or more shop ids are out of range")
+    except DataError as dberror:
+        raise HTTPException(status_code=422, detail=f"invalid treasure: {dberror.diag.message_primary}")
+    response_cache.invalidate()
+    return {"treasures" : created}
 
 @app.patch("/api/treasures/{treasure_id}", status_code=204)
-def patch_treasure(treasure_id: int, new_price: NewPrice):
-    conn = connect_to_db()
-
-    get_current_price = conn.run("SELECT cost_at_auction FROM treasures WHERE treasure_id = :id", id = treasure_id)
-    if new_price.cost_at_auction >= get_current_price[0][0]:
-        raise ValueError(f"The current price is {get_current_price[0][0]}, please enter a lower price")
-
-    set_new_price = conn.run(f"""UPDATE treasures
-                             SET cost_at_auction = :price
-                             WHERE treasure_id = :id
-                             RETURNING *""", price = new_price.cost_at_auction, id = treasure_id)
-    conn.close()
+def patch_treasure(treasure_id: int, new_price: NewPrice,
+                   conn: Connection = Depends(get_conn)):
+    # Read, compare and update in one round trip. FOR UPDATE stops a
+    # concurrent patch from changing the price between the check and the write.
+    try:
+        patched = conn.execute("""WITH cur AS (
+                                  SELECT cost_at_auction FROM treasures
+                                  WHERE treasure_id = %(id)s
+                                  FOR UPDATE),
+                              updated AS (
+                                  UPDATE treasures
+                                  SET cost_at_auction = %(price)s
+                                  WHERE treasure_id = %(id)s
+                                  -- Compare as REAL, the column type, so an equal price
+                                  -- is not widened to float8 and read as lower.
+                                  AND CAST(%(price)s AS REAL) < (SELECT cost_at_auction FROM cur)
+                                  RETURNING 1)
+                              SELECT cur.cost_at_auction,
+                                     EXISTS (SELECT 1 FROM updated) AS updated
+                              FROM cur""", {"price" : new_price.cost_at_auction, "id" : treasure_id}).fetchone()
+    except DataError as dberror:
+        raise HTTPException(status_code=422, detail=f"invalid price: {dberror.diag.message_primary}")
+    if patched is None:
+        raise HTTPException(status_code=404, detail=f"There is no treasure with id {treasure_id}")
+    if not patched["updated"]:
+        raise ValueError(f"The current price is {patched['cost_at_auction']}, please enter a lower price")
+
+    response_cache.invalidate()
     
 @app.delete("/api/treasures/{treasure_id}", status_code=204)
-def delete_treasure(treasure_id: int):
-    conn = connect_to_db()
-    deleted = conn.run("""DELETE from treasures
-                       WHERE treasure_id = :id
-                       RETURNING*"""
-                       , id = treasure_id)
-    if not deleted:
-        raise ValueError(f"There is no treasure with id {treasure_id}")
-    
-    print(f"treasure {treasure_id} has been deleted")
-    conn.close()
+def delete_treasure(treasure_id: int, conn: Connection = Depends(get_conn)):
+    deleted = conn.execute("""DELETE from treasures
+                       WHERE treasure_id = %(id)s""", {"id" : treasure_id})
+    if deleted.rowcount == 0:
+        raise HTTPException(status_code=404, detail=f"There is no treasure with id {treasure_id}")
+    response_cache.invalidate()
+
+    logger.info("treasure %s deleted", treasure_id)
     return
 
 @app.get("/api/shops")
-def get_shops():
-    conn = connect_to_db()    
-    shops = conn.run('''SELECT shop_id, shop_name, slogan
+def get_shops(conn: Connection = Depends(get_conn)):
+    cached = response_cache.get(("shops",))
+    if cached is not None:
+        return Response(cached, media_type="application/json")
+    cache_version = response_cache.version
+
+    shops = conn.execute('''SELECT shops.shop_id, shops.shop_name, shops.slogan,
+                     COALESCE(ROUND(SUM(treasures.cost_at_auction)::numeric, 2), 0)::float
+                     AS "stock value"
                      FROM shops
-                     ''')
-
-    treasures_cost = conn.run('''
-                              SELECT shop_id, SUM(cost_at_auction)
-                              FROM treasures 
-                              GROUP BY shop_id  
-                              ''')
-
-    response = []
-    for shop in shops:
-        new_shop = {'shop_id': shop[0], 'shop_name': shop[1], 'slogan': shop[2]}
-
-        for stock in treasures_cost:
-            if stock[0] == new_shop['shop_id']:
-                new_shop['stock value'] = round(stock[1], 2)
-        response.append(new_shop)  
-
-    response = {'shops': response}
-    conn.close()
-    return response
+                     LEFT JOIN treasures ON treasures.shop_id = shops.shop_id
+                     GROUP BY shops.shop_id, shops.shop_name, shops.slogan
+                     ORDER BY shops.shop_id
+                     ''').fetchall()
+
+    body = orjson.dumps({'shops': shops})
+    response_cache.set(("shops",), body, cache_version)
+    return Response(body, media_type="application/json")
 
 
     